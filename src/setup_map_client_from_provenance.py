@@ -1,11 +1,18 @@
 import argparse
-import json
+import hashlib
 import os.path
 import platform
+import shutil
 import subprocess
 import sys
+import threading
 
-from packaging.version import Version
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
 
 
 RETURN_CODES = {
@@ -21,6 +28,10 @@ RETURN_CODES = {
     "MAPCLIENT_USE_FAILED": 10,
 }
 
+MIRROR_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "map-client-mirrors")
+
+PLUGIN_MARKER_FILE = "mapclient-ok"
+
 
 def _description_text():
     return_codes = ';'.join(' {} - {}'.format(val, key) for key, val in RETURN_CODES.items())
@@ -40,144 +51,167 @@ def _parse_args():
     return parser.parse_args()
 
 
-def _which(cmd, mode=os.F_OK | os.X_OK, path=None):
-    """Given a command, mode, and a PATH string, return the path which
-    conforms to the given mode on the PATH, or None if there is no such
-    file.
+def _load_map_client_provenance(provenance_file):
+    try:
+        with open(provenance_file, "rb") as fh:
+            content = _json_loads(fh.read())
+    except (OSError, ValueError):
+        return None
 
-    `mode` defaults to os.F_OK | os.X_OK. `path` defaults to the result
-    of os.environ.get("PATH"), or can be overridden with a custom search
-    path.
+    if "id" in content and content["id"] == "map-client-provenance-record-report" and "version" in content:
+        return content
 
-    """
-    # Check that a given file can be accessed with the correct mode.
-    # Additionally check that `file` is not a directory, as on Windows
-    # directories pass the os.access check.
-    def _access_check(fn, permissions):
-        return (os.path.exists(fn) and os.access(fn, permissions)
-                and not os.path.isdir(fn))
-
-    # If we're given a path with a directory part, look it up directly rather
-    # than referring to PATH directories. This includes checking relative to the
-    # current directory, e.g. ./script
-    if os.path.dirname(cmd):
-        if sys.platform == "win32":
-            # PATHEXT is necessary to check on Windows.
-            pathext = os.environ.get("PATHEXT", "").split(os.pathsep)
-            if any(cmd.lower().endswith(ext.lower()) for ext in pathext):
-                files = [cmd]
-            else:
-                files = [cmd + ext for ext in pathext]
-        else:
-            files = [cmd]
-        for name in files:
-            if _access_check(name, mode):
-                return name
+    return None
 
-        return None
 
-    if path is None:
-        path = os.environ.get("PATH", os.defpath)
-    if not path:
-        return None
-    path = path.split(os.pathsep)
+def _iter_requirements(info):
+    yield f"mapclient == {info['mapclient']['version']}"
+    for package, package_data in info["packages"].items():
+        if package_data['location'] != "PyPI":
+            print(f"Package: {package} is not installed from PyPI!")
+        yield f"{package} == {package_data['version']}"
 
+
+def _plugin_requirements(info):
+    return info
+
+
+def _validate_plugins(info):
+    for plugin, plugin_data in info.items():
+        if not isinstance(plugin_data, dict) or not isinstance(plugin_data.get("version"), str) or not isinstance(plugin_data.get("location"), str):
+            print(f"Plugin: {plugin} does not record both a version and a location.")
+            return False
+
+    return True
+
+
+def _venv_bin(base_dir, name, app_name):
     if sys.platform == "win32":
-        # The current directory takes precedence on Windows.
-        if not os.curdir in path:
-            path.insert(0, os.curdir)
-
-        # PATHEXT is necessary to check on Windows.
-        pathext = os.environ.get("PATHEXT", "").split(os.pathsep)
-        # See if the given file matches any of the expected path extensions.
-        # This will allow us to short circuit when given "python.exe".
-        # If it does match, only test that one, otherwise we have to try
-        # others.
-        if any(cmd.lower().endswith(ext.lower()) for ext in pathext):
-            files = [cmd]
-        else:
-            files = [cmd + ext for ext in pathext]
-    else:
-        # On other platforms you don't have things like PATHEXT to tell you
-        # what file suffixes are executable, so just pass on cmd as-is.
-        files = [cmd]
-
-    seen = set()
-    for directory in path:
-        normdir = os.path.normcase(directory)
-        if not normdir in seen:
-            seen.add(normdir)
-            for thefile in files:
-                name = os.path.join(directory, thefile)
-                if _access_check(name, mode):
-                    return name
+        return os.path.join(base_dir, name, "Scripts", app_name + ".exe")
+    return os.path.join(base_dir, name, "bin", app_name)
 
-    return None
 
+def _get_virtual_environment_pip(base_dir, name):
+    return _venv_bin(base_dir, name, "pip")
 
-def _is_map_client_provenance_file(provenance_file):
-    if not os.path.isfile(provenance_file):
-        return False
 
-    with open(provenance_file) as fh:
-        content = json.load(fh)
+def _get_virtual_environment_map_client_use(base_dir, name):
+    return _venv_bin(base_dir, name, "mapclient_use")
 
-    return "id" in content and content["id"] == "map-client-provenance-record-report" and "version" in content
 
+def _get_virtual_environment_python(base_dir, name):
+    return _venv_bin(base_dir, name, "python")
 
-def _map_client_requirements(info):
-    return [f"mapclient == {info['version']}"]
 
+def _get_virtual_environment_version(base_dir, name):
+    try:
+        with open(os.path.join(base_dir, name, "pyvenv.cfg")) as fh:
+            for line in fh:
+                key, _, value = line.partition("=")
+                if key.strip() == "version":
+                    return value.strip()
+    except OSError:
+        pass
 
-def _package_requirements(info):
-    r = []
-    for package, package_data in info.items():
-        r.append(f"{package} == {package_data['version']}")
-        if package_data['location'] != "PyPI":
-            print(f"Package: {package} is not installed from PyPI!")
+    return None
 
-    return r
 
+def _fast_make_venv(base_dir, name, exists):
+    reusable = exists and _get_virtual_environment_version(base_dir, name) == platform.python_version()
+    if reusable and os.path.isfile(_get_virtual_environment_pip(base_dir, name)):
+        return 0
 
-def _plugin_requirements(info):
-    return info
+    virtual_environment_python_exe = _get_virtual_environment_python(base_dir, name)
+    if not reusable or not os.path.isfile(virtual_environment_python_exe):
+        result = subprocess.run([sys.executable, "-m", "venv", "--clear", "--without-pip", name], cwd=base_dir)
+        if result.returncode != 0:
+            return result.returncode
 
+    result = subprocess.run([virtual_environment_python_exe, "-m", "ensurepip", "--upgrade", "--default-pip"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        print(result.stderr.decode(errors="replace"))
+    return result.returncode
 
-def _get_exe_part(base_dir, name, app_name):
-    common_part = os.path.commonpath([sys.executable, sys.prefix])
-    end_part = sys.executable.replace(common_part + os.path.sep, "")
-    exe_part = end_part.replace("python", app_name, 1)
 
-    return os.path.join(base_dir, name, exe_part)
+def _ensure_mirror(git_exe, url, lock):
+    mirror_path = os.path.join(MIRROR_CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".git")
+    with lock:
+        try:
+            if os.path.isdir(mirror_path):
+                result = subprocess.run([git_exe, "-C", mirror_path, "fetch", "--tags", "origin"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                if result.returncode == 0:
+                    return mirror_path
 
+                shutil.rmtree(mirror_path)
+            else:
+                os.makedirs(MIRROR_CACHE_DIR, exist_ok=True)
 
-def _get_virtual_environment_pip(base_dir, name):
-    return _get_exe_part(base_dir, name, "pip")
+            result = subprocess.run([git_exe, "clone", "--bare", "--filter=blob:none", url, mirror_path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError:
+            return None
 
+    return mirror_path if result.returncode == 0 else None
 
-def _get_virtual_environment_map_client_use(base_dir, name):
-    return _get_exe_part(base_dir, name, "mapclient_use")
+
+def _clone_and_switch(git_exe, plugin_dir, p, p_data, exists, mirror_lock):
+    version = f"v{p_data['version']}"
+    marker_file = os.path.join(plugin_dir, p, ".git", PLUGIN_MARKER_FILE)
+    if exists:
+        try:
+            with open(marker_file) as fh:
+                if fh.read() == p_data["version"]:
+                    return p, 0, b""
+        except OSError:
+            pass
+
+        result = subprocess.run([git_exe, "rev-parse", "--verify", "--quiet", f"refs/heads/{version}"], cwd=os.path.join(plugin_dir, p), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            result = subprocess.run([git_exe, "switch", "-c", version], cwd=os.path.join(plugin_dir, p), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    else:
+        mirror_path = _ensure_mirror(git_exe, p_data["location"], mirror_lock)
+        if mirror_path is None:
+            clone_options = ["--filter=blob:none", "--depth", "1"]
+        else:
+            clone_options = ["--filter=blob:none", "--reference", mirror_path, "--dissociate"]
+
+        result = subprocess.run([git_exe, "-c", "advice.detachedHead=false", "clone", *clone_options, "--branch", version, p_data["location"], p],
+                                cwd=plugin_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    if result.returncode == 0:
+        try:
+            with open(marker_file, "w") as fh:
+                fh.write(p_data["version"])
+        except OSError:
+            pass
+
+    return p, result.returncode, result.stderr
 
 
 def _platform_match(info):
-    return Version(platform.python_version()) == Version(info["version"]) and info["platform"] == sys.platform
+    return platform.python_version() == info["version"] and info["platform"] == sys.platform
 
 
 def main():
     venv_directory_name = "venv_map_client"
     args = _parse_args()
+    args.setup_dir = os.path.abspath(args.setup_dir)
 
-    if not os.path.isdir(args.setup_dir):
+    try:
+        with os.scandir(args.setup_dir) as it:
+            entries = {entry.name: entry for entry in it}
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
         return RETURN_CODES["SETUP_DIR_INVALID"]
 
-    if not _is_map_client_provenance_file(args.provenance_file):
+    content = _load_map_client_provenance(args.provenance_file)
+    if content is None:
         return RETURN_CODES["PROVENANCE_FILE_INVALID"]
 
-    with open(args.provenance_file) as fh:
-        content = json.load(fh)
-
     software_info = content["software_info"]
-    if Version(content["version"]) == Version("0.1.0"):
+    plugin_requirements = _plugin_requirements(software_info["plugins"])
+    if not _validate_plugins(plugin_requirements):
+        return RETURN_CODES["PROVENANCE_FILE_INVALID"]
+
+    if content["version"] == "0.1.0":
         if sys.platform == "darwin":
             python_info = {"version": "3.11.11", "platform": "darwin"}
         else:
@@ -191,46 +225,62 @@ def main():
               f"the current system has been detected as {sys.platform} at version {platform.python_version()} which is not suitable.")
         return RETURN_CODES["PLATFORM_MISMATCH"]
 
-    git_exe = _which("git")
+    git_exe = shutil.which("git")
     if git_exe is None:
         return RETURN_CODES["GIT_EXECUTABLE_NOT_FOUND"]
 
-    map_client_requirement = _map_client_requirements(software_info["mapclient"])
-    package_requirements = _package_requirements(software_info["packages"])
-    requirements = map_client_requirement + package_requirements
+    requirements = "\n".join(_iter_requirements(software_info))
 
-    plugin_requirements = _plugin_requirements(software_info["plugins"])
-
-    result = subprocess.run([sys.executable, "-m", "venv", venv_directory_name], cwd=args.setup_dir)
-    if result.returncode != 0:
+    if _fast_make_venv(args.setup_dir, venv_directory_name, venv_directory_name in entries) != 0:
         return RETURN_CODES["VIRTUALENV_SETUP_FAILED"]
 
-    with open(os.path.join(args.setup_dir, "requirements.txt"), "w") as fh:
-        fh.write("\n".join(requirements))
-
     virtual_environment_pip_exe = _get_virtual_environment_pip(args.setup_dir, venv_directory_name)
 
-    result = subprocess.run([virtual_environment_pip_exe, "install", "-r", "requirements.txt"], cwd=args.setup_dir, capture_output=True)
+    pip_env = os.environ.copy()
+    pip_env.update({"PIP_DISABLE_PIP_VERSION_CHECK": "1", "PIP_NO_INPUT": "1"})
+    pip_install = [virtual_environment_pip_exe, "install", "--prefer-binary"]
+    if sys.platform == "win32":
+        with open(os.path.join(args.setup_dir, "requirements.txt"), "w") as fh:
+            fh.write(requirements)
+
+        result = subprocess.run(pip_install + ["-r", "requirements.txt"], cwd=args.setup_dir, env=pip_env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    else:
+        result = subprocess.run(pip_install + ["-r", "/dev/stdin"], input=requirements.encode(), cwd=args.setup_dir, env=pip_env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
     if result.returncode != 0:
+        print(result.stderr.decode(errors="replace"))
         return RETURN_CODES["REQUIREMENTS_INSTALL_FAILED"]
 
     plugin_dir = os.path.join(args.setup_dir, "plugins")
-    os.makedirs(plugin_dir, exist_ok=True)
-
-    for p, p_data in plugin_requirements.items():
-        if os.path.exists(os.path.join(plugin_dir, p)):
-            result = subprocess.run(["echo", os.path.join(plugin_dir, p)])
+    if "plugins" in entries and entries["plugins"].is_dir():
+        with os.scandir(plugin_dir) as it:
+            existing = {entry.name for entry in it}
+    else:
+        os.makedirs(plugin_dir, exist_ok=True)
+        existing = set()
+
+    mirror_locks = {p_data["location"]: threading.Lock() for p_data in plugin_requirements.values()}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(plugin_requirements)))) as executor:
+        futures = [executor.submit(_clone_and_switch, git_exe, plugin_dir, p, p_data, p in existing, mirror_locks[p_data["location"]])
+                   for p, p_data in plugin_requirements.items()]
+        for future in futures:
+            p, returncode, stderr = future.result()
+            if returncode != 0:
+                failed[p] = stderr
+
+    return_code = 0
+    for p, stderr in failed.items():
+        version = f"v{plugin_requirements[p]['version']}"
+        if p not in existing:
+            print(f"Failed to clone: {p} @ {version}.")
+            return_code = return_code or RETURN_CODES["PLUGIN_CLONE_FAILED"]
         else:
-            result = subprocess.run([git_exe, "clone", "--depth",  "1", "--branch", f"v{p_data['version']}", p_data["location"], p], cwd=plugin_dir, capture_output=True)
-
-        if result.returncode != 0:
-            print(f"Failed to clone: {p} @ v{p_data['version']}.")
-            return RETURN_CODES["PLUGIN_CLONE_FAILED"]
+            print(f"Failed to switch branch for: {p} to {version}.")
+            return_code = return_code or RETURN_CODES["GIT_SWITCH_FAILED"]
+        print(stderr.decode(errors="replace"))
 
-        result = subprocess.run([git_exe, "switch", "-c", f"v{p_data['version']}"], cwd=os.path.join(plugin_dir, p), capture_output=True)
-        if result.returncode != 0 and result.stderr.decode() != f"fatal: a branch named 'v{p_data['version']}' already exists\n":
-            print(f"Failed to switch branch to v{p_data['version']}.")
-            return RETURN_CODES["GIT_SWITCH_FAILED"]
+    if return_code:
+        return return_code
 
     map_client_use_exe = _get_virtual_environment_map_client_use(args.setup_dir, venv_directory_name)
     result = subprocess.run([map_client_use_exe, args.setup_dir, "-d", plugin_dir])